@@ -5,21 +5,83 @@ Currently available:
 """
 
 import os
-from dataclasses import dataclass
-from io import BytesIO
-from logging import Logger, getLogger
-from typing import List, Mapping, Optional, Sequence
-from urllib.request import urlopen
+import re
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, fields
+from datetime import date
+from logging import INFO, Logger, getLogger
+from tempfile import TemporaryFile
+from typing import (
+    IO,
+    Any,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Tuple,
+)
+from urllib.parse import urljoin
 from zipfile import ZipFile
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 import requests
-import tiledb
-import tiledb.cloud
 import toml
-from attrs import define, field
+from attrs import Attribute, define, field
+from pyarrow import csv as pacsv
 from pydantic.dataclasses import dataclass as pydantic_dataclass
 
+# local copy of VDJdb, reused between runs
+_VDJDB_CACHE = ".vdjdb.parquet"
+# gzipped tsv cache written by earlier versions
+_LEGACY_VDJDB_CACHE = ".vdjdb_tsv.gz"
+
+# common v/j patterns to match and what to replace if found, compiled once at import
+_VJ_PATTERNS = (
+    (re.compile(r"(T)(R[ABVJ]+)(.*)"), r"\1C\2\3"),  # handles TRVB to TCRVB
+    (re.compile(r"(?P<tcr>[TCRABVJ]+)(\d)(?!\d)"), r"\g<tcr>0\2"),
+    (re.compile(r"(?P<dash>\-)(\d)(?!\d)"), r"\g<dash>0\2"),  # handles -4 to -04
+)
+
+# pandas' default read_csv NA tokens, read as empty strings as VDJdb always has been
+_NA_VALUES = [
+    "",
+    "#N/A",
+    "#N/A N/A",
+    "#NA",
+    "-1.#IND",
+    "-1.#QNAN",
+    "-NaN",
+    "-nan",
+    "1.#IND",
+    "1.#QNAN",
+    "<NA>",
+    "N/A",
+    "NA",
+    "NULL",
+    "NaN",
+    "None",
+    "n/a",
+    "nan",
+    "null",
+]
+
+
+def _string_dtype(pa_type: pa.DataType) -> Optional[pd.StringDtype]:
+    """Map arrow text to the dtype pandas restores text with from Parquet."""
+
+    if pa.types.is_string(pa_type) or pa.types.is_large_string(pa_type):
+        return pd.StringDtype("pyarrow")
+
+    return None
+
 
 @dataclass(frozen=False)
 class QueryResult:
@@ -35,19 +97,103 @@ class QueryResult:
     """Database queried."""
     path: str = field(init=False)
 
-    def output(self, path: str) -> None:
+    def _write_tsv(self, path: str) -> bool:
+        """Write results as tsv with Arrow's C++ csv writer.
+
+        Args:
+            path:
+                Path to output file.
+
+        Returns:
+            Whether results could be written the same as pandas would.
+        """
+
+        # pandas writes a named index under its name and one header row per column level
+        result = self.result
+        if result.index.nlevels > 1 or result.columns.nlevels > 1 or any(result.index.names):
+            return False
+
+        # pandas quotes header fields that need it, and a lone empty index header
+        if result.columns.empty or any(set('"\t\r\n') & set(str(c)) for c in result.columns):
+            return False
+
+        # index as an unnamed first column, as pandas writes it
+        table = pa.Table.from_pandas(result.reset_index(names=""), preserve_index=False)
+
+        index_type, *col_types = table.schema.types
+        if not (pa.types.is_integer(index_type) or pa.types.is_string(index_type)):
+            return False
+
+        # only text and dates are formatted as pandas does, e.g. arrow lowercases bools
+        for col_type in col_types:
+            if pa.types.is_timestamp(col_type) and col_type.tz is None:
+                continue
+
+            if pa.types.is_dictionary(col_type):
+                col_type = col_type.value_type
+
+            if not (pa.types.is_string(col_type) or pa.types.is_large_string(col_type)):
+                return False
+
+        for i, (name, col) in enumerate(zip(table.column_names, table.columns)):
+            if pa.types.is_timestamp(col.type):
+                # pandas writes midnight timestamps as plain dates, arrow can't otherwise match
+                day = col.cast(pa.date32())
+                if not day.cast(col.type).equals(col):
+                    return False
+
+                table = table.set_column(i, name, day)
+
+        try:
+            with open(path, "wb") as out:
+                # arrow always quotes the header, so write it as pandas does
+                out.write(("\t".join(table.column_names) + "\n").encode())
+                pacsv.write_csv(
+                    table,
+                    out,
+                    write_options=pacsv.WriteOptions(
+                        include_header=False,
+                        delimiter="\t",
+                        quoting_style="none",
+                    ),
+                )
+
+        except pa.ArrowInvalid:  # a value needs quoting
+            return False
+
+        return True
+
+    def output(self, path: str, link_from: Optional[str] = None) -> None:
         """Output results to a file.
 
         Args:
             path:
                 Path to output file.
+            link_from:
+                Existing output of the same results, hard linked to path
+                instead of writing the results again where possible.
 
         Returns:
             Path to output file.
         """
 
         os.makedirs(os.path.dirname(path), exist_ok=True)
-        self.result.to_csv(path, sep="\t")
+
+        # may be hard linked by an earlier run, never write through the link
+        if os.path.lexists(path):
+            os.remove(path)
+
+        if link_from:
+            try:
+                os.link(link_from, path)
+                self.path = path
+                return
+
+            except OSError:  # e.g. filesystem without hard links, write instead
+                pass
+
+        if not self._write_tsv(path):
+            self.result.to_csv(path, sep="\t")
 
         self.path = path
 
@@ -71,6 +217,8 @@ class QueryResult:
                 S3 bucket to upload to.
         """
 
+        import tiledb  # heavy native extension, only loaded when uploading
+
         config = tiledb.Config()
         config["rest.token"] = os.environ["TILEDB_TOKEN"]
 
@@ -98,6 +246,18 @@ class VdjdbMeta:
     """Identifier for a single complex, beta and alpha loci of the
     same receptor have the sample complex index."""
 
+    def __iter__(self) -> Iterator[str]:
+        return (getattr(self, field.name) for field in fields(self))
+
+
+def _reset_vdjdb_state(instance: "PublicTcrDb", attribute: Attribute, value: Any) -> Any:
+    """Drop state derived from the rows of a VDJdb that is being replaced."""
+
+    instance._presorted = False
+    instance._shared_matches = {}
+
+    return value
+
 
 @define
 class PublicTcrDb:
@@ -110,7 +270,26 @@ class PublicTcrDb:
     def _logger(self) -> Logger:
         return getLogger(__name__)
 
-    vdjdb: pd.DataFrame = field(init=False)
+    # presort and shared matches describe the rows, so reassigning vdjdb resets them;
+    # modify a copy and assign it rather than editing rows in place
+    vdjdb: Optional[pd.DataFrame] = field(init=False, default=None, on_setattr=_reset_vdjdb_state)
+    _session: requests.Session = field(init=False, factory=requests.Session)
+    _release_etag: Optional[str] = field(init=False, default=None)
+    _construct_cols: List[str] = field(init=False)
+
+    @_construct_cols.default
+    def _construct_cols_default(self) -> List[str]:
+        return list(self.vdjdb_meta)
+
+    _sort_cols: List[str] = field(init=False)
+
+    @_sort_cols.default
+    def _sort_cols_default(self) -> List[str]:
+        # complex identifies same alpha-beta pair; also list alpha before beta
+        return [self.vdjdb_meta.complex, self.vdjdb_meta.gene]
+
+    _presorted: bool = field(init=False, default=False)
+    _shared_matches: Dict[Tuple[str, str], np.ndarray] = field(init=False, factory=dict)
 
     def _fix_vj_format(self) -> None:
         """For v/j segments listed as TRAV8-1 for example, need to transform to
@@ -120,22 +299,43 @@ class PublicTcrDb:
         Uses named capture group 'tcr' to avoid capture group \n issues.
         """
 
-        # holds common patterns to match and what to replace if found
-        pat_rep = {
-            "(T)(R[ABVJ]+)(.*)": r"\1C\2\3",  # handles TRVB to TCRVB
-            "(?P<tcr>[TCRABVJ]+)(\d)(?!\d)": r"\g<tcr>0\2",
-            "(?P<dash>\-)(\d)(?!\d)": r"\g<dash>0\2",  # handles -4 to -04
-        }
+        v, j = self.vdjdb_meta.v, self.vdjdb_meta.j
 
-        # iteratively look for known patterns to change and fix for v and j
-        for p, r in pat_rep.items():
-            self.vdjdb[[self.vdjdb_meta.v, self.vdjdb_meta.j]] = self.vdjdb[
-                [self.vdjdb_meta.v, self.vdjdb_meta.j]
-            ].replace(
-                to_replace=p,
-                value=r,
-                regex=True,
-            )
+        # segments repeat heavily, so only fix each distinct value once
+        fixed = {}
+        for segm in pd.unique(pd.concat([self.vdjdb[v], self.vdjdb[j]])):
+            new = segm
+            # sequentially apply known patterns to change
+            for p, r in _VJ_PATTERNS:
+                new = p.sub(r, new)
+            fixed[segm] = new
+
+        self.vdjdb[v] = self.vdjdb[v].map(fixed)
+        self.vdjdb[j] = self.vdjdb[j].map(fixed)
+
+    def _download(self, url: str) -> IO[bytes]:
+        """Stream a remote file into a temporary file.
+
+        Args:
+            url:
+                Location of the file to download.
+
+        Returns:
+            Temporary file holding the download, rewound to the start.
+        """
+
+        # a real file, zipfile needs seekable() which spooled files lack before 3.11
+        buf = TemporaryFile()
+
+        with self._session.get(url, stream=True) as resp:
+            resp.raise_for_status()
+
+            for chunk in resp.iter_content(chunk_size=1 << 20):
+                buf.write(chunk)
+
+        buf.seek(0)
+
+        return buf
 
     def _extract_dfs(
         self,
@@ -157,44 +357,162 @@ class PublicTcrDb:
             uncompressed files as dataframe representations.
         """
 
-        zip_resp = urlopen(zip_url)
-
-        all_contents = ZipFile(BytesIO(zip_resp.read()))
+        # today's date for tracking, shared by every extracted file
+        today = np.datetime64(date.today(), "ns")
 
         dfs = []
-        for selection in files:
-            try:
-                dbdf = pd.read_csv(
-                    all_contents.open(selection),
-                    sep="\t",
-                    dtype=str,
-                )
+        with self._download(zip_url) as buf, ZipFile(buf) as all_contents:
+            for selection in files:
+                try:
+                    with all_contents.open(selection) as header:
+                        colnames = header.readline().decode().rstrip("\r\n").split("\t")
+
+                    # multithreaded arrow parse, keeping every column as text
+                    with all_contents.open(selection) as txt:
+                        table = pacsv.read_csv(
+                            txt,
+                            parse_options=pacsv.ParseOptions(delimiter="\t"),
+                            convert_options=pacsv.ConvertOptions(
+                                column_types=dict.fromkeys(colnames, pa.string()),
+                                null_values=_NA_VALUES,
+                                strings_can_be_null=True,
+                            ),
+                        )
 
-                # perform some fitlering for tiledb upload
-                dbdf = dbdf.fillna("")
-                # add column with today's date for tracking
-                dbdf["date_pulled"] = pd.to_datetime("today").strftime("%Y-%m-%d")
-                dbdf["date_pulled"] = dbdf["date_pulled"].astype("datetime64[ns]")
+                    if human_only:  # drop other species before converting them to pandas
+                        table = table.filter(pc.equal(table["species"], "HomoSapiens"))
 
-                if human_only:
-                    dbdf = dbdf[dbdf["species"] == "HomoSapiens"].reset_index(drop=True)
+                    dbdf = table.to_pandas(types_mapper=_string_dtype).fillna("")
 
-                dfs.append(dbdf)
+                    dbdf["date_pulled"] = today
 
-            except KeyError:
-                self.logger.debug("%s was not found, skipping.." % selection)
+                    dfs.append(dbdf)
+
+                except KeyError:
+                    self.logger.debug("%s was not found, skipping..", selection)
 
         return dfs
 
+    def _categorize(self) -> None:
+        """Store columns whose few distinct values repeat across rows as
+        integer coded categoricals."""
+
+        cat_cols = [self.vdjdb_meta.gene, self.vdjdb_meta.v, self.vdjdb_meta.j, "species"]
+        for col in cat_cols:
+            values = self.vdjdb[col].astype("category")  # no-op if already categorical
+            # parquet restores categories as object, keep them the same as a fresh download
+            categories = values.cat.categories.astype(pd.StringDtype("pyarrow"))
+            self.vdjdb[col] = pd.Categorical.from_codes(values.cat.codes, categories)
+
+    def _presort(self) -> None:
+        """Sort VDJdb once by complex and gene.
+
+        Row filters preserve this order, so results from find no longer
+        need sorting individually.
+        """
+
+        self.vdjdb = self.vdjdb.sort_values(self._sort_cols, kind="stable")
+        self._presorted = True  # set after assigning, which resets it
+
+    def _load_cache(self) -> Optional[str]:
+        """Load VDJdb from the local cache, if there is one.
+
+        Falls back to the gzipped tsv cache written by earlier versions.
+
+        Returns:
+            Path of the cache VDJdb was loaded from, if any.
+        """
+
+        if os.path.exists(_VDJDB_CACHE):
+            # restore text with the same arrow backed dtype a fresh download has
+            with pd.option_context("mode.string_storage", "pyarrow"):
+                self.vdjdb = pd.read_parquet(_VDJDB_CACHE)
+            self._release_etag = self.vdjdb.attrs.get("release_etag")
+            path = _VDJDB_CACHE
+
+        elif os.path.exists(_LEGACY_VDJDB_CACHE):
+            self.vdjdb = pd.read_csv(
+                _LEGACY_VDJDB_CACHE,
+                sep="\t",
+                dtype=pd.StringDtype("pyarrow"),
+                keep_default_na=False,
+                parse_dates=["date_pulled"],
+            )
+            path = _LEGACY_VDJDB_CACHE
+
+        else:
+            return None
+
+        # no-op for columns already categorical in the cache
+        self._categorize()
+        self._presort()
+
+        return path
+
+    @staticmethod
+    def _contains(values: pd.Series, value: str) -> np.ndarray:
+        """Vectorized literal substring match against a VDJdb column.
+
+        Categorical columns only match against their categories, then map
+        the hits back to rows through the category codes. When only one
+        category matches, rows are compared on that code directly.
+
+        Args:
+            values:
+                VDJdb column, or a row subset of it, to search.
+            value:
+                Substring to look for.
+
+        Returns:
+            Boolean mask over the rows of values.
+        """
+
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            categories = values.cat.categories
+            # na=False so a non-bool result can never match every category
+            matched = categories.str.contains(value, regex=False, na=False)
+            hits = np.flatnonzero(np.asarray(matched, dtype=bool))
+            codes = values.cat.codes.to_numpy()
+
+            # e.g. an exact gene name, reduces to a single int compare per row
+            if len(hits) == 1:
+                return codes == hits[0]
+
+            return np.isin(codes, hits)
+
+        return values.str.contains(value, regex=False, na=False).to_numpy()
+
+    def _share_matches(self, searches: Iterable[Mapping[str, str]]) -> None:
+        """Precompute matches for search params used by more than one query.
+
+        Each shared param is then scanned once over VDJdb, rather than
+        once per query using it.
+
+        Args:
+            searches:
+                Parameters of each query to be run through find.
+        """
+
+        # toml values may be numbers, match on their text as find does
+        counts = Counter((k, str(v)) for search in searches for k, v in search.items())
+
+        self._shared_matches = {
+            (k, v): self._contains(self.vdjdb[k], v) for (k, v), n in counts.items() if n > 1
+        }
+
     def get_vdjdb(
         self,
         api: str = "https://api.github.com",
         latest_release: str = "repos/antigenomics/vdjdb-db/releases/latest",
         txt_file: str = "vdjdb.slim.txt",
         cache: bool = True,
+        cache_ttl: float = 86400,
     ) -> None:
         """Obtain a copy of VDJdb from the latest available release.
 
+        A local cache younger than cache_ttl is used as is. Older caches
+        are only replaced once a new VDJdb release is out.
+
         Args:
             api:
                 Github api.
@@ -204,38 +522,66 @@ class PublicTcrDb:
                 DB file to extract from compression.
             cache:
                 Whether to cache VDJdb locally for faster retrieval later.
+            cache_ttl:
+                Seconds a local cache is used before checking for a new release.
         """
 
-        resp = requests.get(os.path.join(api, latest_release))
+        cache_path = self._load_cache() if cache and self.vdjdb is None else None
+        if cache_path and time.time() - os.path.getmtime(cache_path) < cache_ttl:
+            self.logger.info("Using VDJdb cached locally at %s", cache_path)
+            return
+
+        headers = {"Accept": "application/vnd.github+json"}
+        if self._release_etag and self.vdjdb is not None:
+            headers["If-None-Match"] = self._release_etag
+
+        release_url = urljoin(api.rstrip("/") + "/", latest_release.lstrip("/"))
+
+        resp = self._session.get(release_url, headers=headers)
         resp.raise_for_status()
 
+        # latest release unchanged since the copy already loaded
+        if resp.status_code == 304:
+            self.logger.info("VDJdb already up to date with the latest release.")
+
+            if cache and os.path.exists(_VDJDB_CACHE):
+                os.utime(_VDJDB_CACHE)  # checked fresh, restart the ttl
+
+            return
+
+        # only kept once this release has replaced the loaded copy
+        release_etag = resp.headers.get("ETag")
+
         zip_uri = resp.json()["assets"][0]["browser_download_url"]
 
-        self.logger.info("VDJdb release found at %s" % zip_uri)
+        self.logger.info("VDJdb release found at %s", zip_uri)
 
         try:
             self.vdjdb = self._extract_dfs(zip_url=zip_uri, files=[txt_file])[0]
 
             self._fix_vj_format()
 
+            self._categorize()
+            self._presort()
+
+            self._release_etag = release_etag
+            # remember the release so later runs can check it has not changed
+            self.vdjdb.attrs["release_etag"] = release_etag
+
             if cache:  # archive a local to reduce scraping bandwidth
-                # can be quite large so compress it
-                self.vdjdb.to_csv(
-                    ".vdjdb_tsv.gz",
-                    sep="\t",
-                    index=False,
-                    compression="gzip",
-                )
+                # columnar and typed, so reloading skips csv parsing entirely
+                self.vdjdb.to_parquet(_VDJDB_CACHE, compression="zstd")
 
-                self.logger.info("VDJdb cached to local as .vdjdb_tsv.gz")
+                self.logger.info("VDJdb cached to local as %s", _VDJDB_CACHE)
 
         except IndexError:
-            self.logger.error("Could not locate %s in VDJdb release" % txt_file)
+            self.logger.error("Could not locate %s in VDJdb release", txt_file)
 
     def find(
         self,
         vdjdb_search: Optional[Mapping[str, str]] = None,
         construct_only: bool = True,
+        sort: bool = True,
     ) -> pd.DataFrame:
         """Query attached DBs for matches.
 
@@ -245,6 +591,9 @@ class PublicTcrDb:
             construct_only:
                 Whether to return only annotations pertinent to the TCR
                 construct (cdr3, v, j).
+            sort:
+                Whether results must be ordered by complex then gene. Free
+                when VDJdb was presorted on load, skipped otherwise if False.
 
         Returns:
             Filtered dataframe based on query params.
@@ -252,30 +601,46 @@ class PublicTcrDb:
 
         if vdjdb_search:
             # get vdjdb if not previously done
-            if self.vdjdb is None:
-                try:
-                    self.vdjdb = pd.read_csv(".vdjdb_tsv.gz", sep="\t")
+            if self.vdjdb is None and not self._load_cache():
+                self.get_vdjdb()
+
+            # precomputed then cheap categorical params first,
+            # so string scans only see surviving rows
+            # toml values may be numbers, always match on their text
+            params = sorted(
+                ((k, str(v)) for k, v in vdjdb_search.items()),
+                key=lambda kv: (
+                    kv not in self._shared_matches,
+                    not isinstance(self.vdjdb[kv[0]].dtype, pd.CategoricalDtype),
+                ),
+            )
 
-                except FileNotFoundError:
-                    self.get_vdjdb()
+            rows = np.arange(len(self.vdjdb))
+            for k, v in params:
+                shared = self._shared_matches.get((k, v))
+                if shared is not None:
+                    rows = rows[shared[rows]]
+                    continue
 
-            # dynamically string together filtering operations
-            v_row_filt = [
-                f"`{k}`.str.contains('{v}', regex = False)" for k, v in vdjdb_search.items()
-            ]
+                values = self.vdjdb[k]
+                if len(rows) < len(values):
+                    values = values.iloc[rows]
 
-            v_result = self.vdjdb.query(" & ".join(v_row_filt), engine="python")
+                rows = rows[self._contains(values, v)]
 
+            cols = slice(None)
             if construct_only:
                 # select only cols relating to construct,
-                # these cols are specified in attributes
-                v_result = v_result.loc[
-                    :,
-                    [self.__dict__[a] for a in self.__dict__ if a.startswith("vdjdb_")],
-                ]
+                # these cols are specified in vdjdb_meta
+                cols = self.vdjdb.columns.get_indexer(self._construct_cols)
+
+            # take rows and cols in one go, so the sort only moves what is returned
+            v_result = self.vdjdb.iloc[rows, cols]
+
+            if sort and not self._presorted:
+                v_result = v_result.sort_values(self._sort_cols, kind="stable")
 
-            # complex identifies same alpha-beta pair; also list alpha before beta
-            return v_result.sort_values([self.vdjdb_meta.complex, self.vdjdb_meta.gene])
+            return v_result
 
         else:
             self.logger.warning("No query params specified, returning entire VDJdb.")
@@ -310,13 +675,13 @@ class PublicTcrDb:
         if query:
             queries = toml.load(query)
 
-            tcrdb.logger.info(
-                "Filtering VDJdb results for: %s"
-                % "".join([f"\n\t>>> {k}: {v}" for k, v in queries.items()])
-            )
+            if tcrdb.logger.isEnabledFor(INFO):  # skip building the listing otherwise
+                tcrdb.logger.info(
+                    "Filtering VDJdb results for: %s",
+                    "".join([f"\n\t>>> {k}: {v}" for k, v in queries.items()]),
+                )
 
-            all_results = []
-            for id in queries:
+            def _query_one(id: str) -> QueryResult:
                 id_result = tcrdb.find(vdjdb_search=queries[id], construct_only=False)
 
                 qresult = QueryResult(
@@ -329,9 +694,34 @@ class PublicTcrDb:
                 if output:
                     qresult.output(path=os.path.join(".vdjdb_queries", f"{id}.tsv"))
 
-                all_results.append(qresult)
+                return qresult
+
+            searched = [id for id in queries if queries[id]]
+            unfiltered = [id for id in queries if not queries[id]]
+
+            tcrdb._share_matches(queries[id] for id in searched)
+
+            # queries only read the shared VDJdb and its kernels release the GIL
+            with ThreadPoolExecutor() as executor:
+                results = dict(zip(searched, executor.map(_query_one, searched)))
+
+            if unfiltered:
+                tcrdb.logger.warning(
+                    "No query params specified for %s, returning entire VDJdb.",
+                    ", ".join(unfiltered),
+                )
+
+            # all return the entire VDJdb, so share it and write it out only once
+            full_path = None
+            for id in unfiltered:
+                results[id] = QueryResult(id=id, result=tcrdb.vdjdb, query=queries[id], db="vdjdb")
+
+                if output:
+                    path = os.path.join(".vdjdb_queries", f"{id}.tsv")
+                    results[id].output(path=path, link_from=full_path)
+                    full_path = path
 
-            return all_results
+            return [results[id] for id in queries]
 
         else:
             tcrdb.logger.info("No query file specified, returning entire VDJdb.")
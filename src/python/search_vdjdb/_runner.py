@@ -1,6 +1,6 @@
 """Top-level runner for search-vdjdb."""
 
-from logging import Logger
+from logging import INFO, Logger
 
 from attrs import define, field
 from click import Command, Option
@@ -58,10 +58,11 @@ class SearchVdjdbRunner:
 
         self.logger.info("Initiating the search-vdjdb entrypoint.")
 
-        self.logger.info(
-            "Parsed arguments: \n\t-- %s"
-            % "\n\t-- ".join(f"{k}: {v}" for k, v in locals().items() if k != "self")
-        )
+        if self.logger.isEnabledFor(INFO):  # skip building the listing otherwise
+            self.logger.info(
+                "Parsed arguments: \n\t-- %s",
+                "\n\t-- ".join(f"{k}: {v}" for k, v in locals().items() if k != "self"),
+            )
 
         results = PublicTcrDb.file_query(query=query, output=output, logger=self.logger)
 
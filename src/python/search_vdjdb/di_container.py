@@ -2,9 +2,9 @@
 
 import sys
 from logging import Formatter, Logger, StreamHandler, getLogger
-from typing import Union
+from typing import Optional, Union
 
-from attrs import define
+from attrs import define, field
 
 from search_vdjdb._config import ArgsConfig, SimpleInput, ValidatedInput
 from search_vdjdb._runner import SearchVdjdbRunner
@@ -16,28 +16,36 @@ class DiContainer:
 
     namespace: str = "prod"
     """Namespace for the container."""
+    _config: Optional[ArgsConfig] = field(init=False, default=None)
+    """Config, created on first use."""
 
     def logger(self) -> Logger:
         """Init logger"""
 
         logger = getLogger(__name__)
-        logger.propagate = False  # don't propagate to root logger
-        logger.addHandler(StreamHandler(sys.stdout))
 
-        # init format
-        lformat = Formatter(
-            fmt="%(asctime)s -- %(message)s\n",
-            datefmt="%d-%b-%y %H:%M:%S",
-        )
-        # set the format for the logger
-        logger.handlers[0].setFormatter(lformat)
+        # loggers are global, only configure on first call
+        if not logger.handlers:
+            logger.propagate = False  # don't propagate to root logger
+            logger.addHandler(StreamHandler(sys.stdout))
+
+            # init format
+            lformat = Formatter(
+                fmt="%(asctime)s -- %(message)s\n",
+                datefmt="%d-%b-%y %H:%M:%S",
+            )
+            # set the format for the logger
+            logger.handlers[0].setFormatter(lformat)
 
         return logger
 
     def config(self) -> ArgsConfig:
         """Init config."""
 
-        return ArgsConfig()
+        if self._config is None:
+            self._config = ArgsConfig()
+
+        return self._config
 
     def runner(
         self,
@@ -3,8 +3,6 @@
 import os
 from typing import Any, Callable
 
-import tiledb
-import tiledb.cloud
 from attrs import define, field
 from pydantic.dataclasses import dataclass as pydantic_dataclass
 
@@ -55,11 +53,15 @@ class UdfClient(TiledbClient):
     def register_udf(self, obj: ObjectRegistration) -> None:
         """Register UDF to TileDB Cloud."""
 
+        import tiledb.cloud  # heavy native extension, only loaded when used
+
         tiledb.cloud.udf.register_generic_udf(obj.executable, name=obj.name)
 
     def run_udf(self, input: UdfInput) -> Any:
         """Run UDF on TileDB Cloud."""
 
+        import tiledb.cloud
+
         response = tiledb.cloud.udf.exec(input.udf, *input.args)
 
         return response
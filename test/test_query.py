@@ -0,0 +1,251 @@
+"""Tests for search_vdjdb._query."""
+
+import pandas as pd
+import pytest
+from search_vdjdb._query import PublicTcrDb, QueryResult
+
+ARROW_STRING = pd.StringDtype("pyarrow")
+
+
+def _text(values) -> pd.Series:
+    return pd.Series(values, dtype=ARROW_STRING)
+
+
+# frames the arrow writer handles, as VDJdb results are typed
+ARROW_FRAMES = {
+    "vdjdb": pd.DataFrame(
+        {
+            "gene": pd.Categorical(["TRA", "TRB", "TRB"]),
+            "cdr3": _text(["CAVRDSNYQLIW", "CASSLAPGATNEKLFF", "CASSIRSSYEQYF"]),
+            "date_pulled": pd.to_datetime(["2024-02-01"] * 3),
+        },
+        index=[4, 0, 7],
+    ),
+    "nulls": pd.DataFrame(
+        {
+            "gene": pd.Categorical(["TRA", None]),
+            "cdr3": _text([None, "CASSF"]),
+        }
+    ),
+    "string_index": pd.DataFrame({"cdr3": _text(["CASSF", ""])}, index=["a", "b"]),
+    "no_rows": pd.DataFrame({"cdr3": _text([])}),
+}
+
+# frames pandas writes differently, so to_csv must be used instead
+FALLBACK_FRAMES = {
+    "quote": pd.DataFrame({"cdr3": _text(['CA"SSF', "CASSF"])}),
+    "tab": pd.DataFrame({"cdr3": _text(["CA\tSSF", "CASSF"])}),
+    "carriage_return": pd.DataFrame({"cdr3": _text(["CA\rSSF", "CASSF"])}),
+    "quoted_category": pd.DataFrame({"gene": pd.Categorical(['TR"A', "TRB"])}),
+    "quoted_header": pd.DataFrame({'cd"r3': _text(["CASSF"])}),
+    "tab_header": pd.DataFrame({"cd\tr3": _text(["CASSF"])}),
+    "bool": pd.DataFrame({"paired": [True, False]}),
+    "float": pd.DataFrame({"score": [1.0, 2.5]}),
+    "named_index": pd.DataFrame({"cdr3": _text(["CASSF"])}).rename_axis("row"),
+    "tz_timestamp": pd.DataFrame({"date_pulled": pd.to_datetime(["2024-02-01"], utc=True)}),
+    "timestamp_with_time": pd.DataFrame({"date_pulled": pd.to_datetime(["2024-02-01 12:30"])}),
+    "no_columns": pd.DataFrame(index=[0, 1]),
+}
+
+
+def _assert_same_as_pandas(result: pd.DataFrame, tmp_path) -> bool:
+    qresult = QueryResult(id="q", result=result, query={}, db="vdjdb")
+    arrow_written = qresult._write_tsv(str(tmp_path / "arrow.tsv"))
+
+    qresult.output(str(tmp_path / "out" / "q.tsv"))
+    result.to_csv(tmp_path / "pandas.tsv", sep="\t")
+
+    assert qresult.path == str(tmp_path / "out" / "q.tsv")
+    assert (tmp_path / "out" / "q.tsv").read_bytes() == (tmp_path / "pandas.tsv").read_bytes()
+
+    return arrow_written
+
+
+@pytest.mark.parametrize("name", ARROW_FRAMES)
+def test_output_arrow_matches_pandas(name, tmp_path):
+    assert _assert_same_as_pandas(ARROW_FRAMES[name], tmp_path)
+
+
+@pytest.mark.parametrize("name", FALLBACK_FRAMES)
+def test_output_falls_back_to_pandas(name, tmp_path):
+    assert not _assert_same_as_pandas(FALLBACK_FRAMES[name], tmp_path)
+
+
+def test_output_recreates_removed_directory(tmp_path):
+    qresult = QueryResult(id="q", result=ARROW_FRAMES["vdjdb"], query={}, db="vdjdb")
+    path = tmp_path / "out" / "q.tsv"
+
+    qresult.output(str(path))
+    path.unlink()
+    path.parent.rmdir()
+    qresult.output(str(path))
+
+    assert path.exists()
+
+
+def test_output_link_from_replaces_existing_file(tmp_path):
+    first = tmp_path / "first.tsv"
+    second = tmp_path / "second.tsv"
+    second.write_text("stale")
+
+    qresult = QueryResult(id="q", result=ARROW_FRAMES["vdjdb"], query={}, db="vdjdb")
+    qresult.output(str(first))
+    qresult.output(str(second), link_from=str(first))
+
+    assert second.read_bytes() == first.read_bytes()
+
+
+def _vdjdb() -> pd.DataFrame:
+    """Small VDJdb excerpt, deliberately not ordered by complex."""
+
+    return pd.DataFrame(
+        {
+            "gene": ["TRB", "TRA", "TRB", "TRB", "TRA", "TRB", "TRA"],
+            "cdr3": [
+                "CASSLAPGATNEKLFF",
+                "CAVRDSNYQLIW",
+                "CASSIRSSYEQYF",
+                "CASSPGQGAYEQYF",
+                "CAGHTGNQFYF",
+                "CASSLAPGTQYF",
+                "CAVNDYKLSF",
+            ],
+            "species": ["HomoSapiens"] * 7,
+            "complex.id": ["10", "10", "0", "210", "100", "100", "0"],
+            "v.segm": [
+                "TCRBV12-01*01",
+                "TCRAV08-01*01",
+                "TCRBV12*01",
+                "TCRBV02-01*01",
+                "TCRAV12-02*01",
+                "TCRBV12-03*01",
+                "TCRAV01-02*01",
+            ],
+            "j.segm": [
+                "TCRBJ01-01*01",
+                "TCRAJ33*01",
+                "TCRBJ02-07*01",
+                "TCRBJ02-07*01",
+                "TCRAJ49*01",
+                "TCRBJ02-05*01",
+                "TCRAJ20*01",
+            ],
+            "vdjdb.score": ["2", "2", "0", "1", "3", "3", "0"],
+        },
+        dtype=ARROW_STRING,
+    )
+
+
+def _tcrdb(prepared: bool = True) -> PublicTcrDb:
+    tcrdb = PublicTcrDb()
+    tcrdb.vdjdb = _vdjdb()
+
+    if prepared:  # as after a download or cache load
+        tcrdb._categorize()
+        tcrdb._presort()
+
+    return tcrdb
+
+
+def _expected(search, sort: bool = True) -> pd.DataFrame:
+    """Plain mask over every row, as find originally filtered."""
+
+    vdjdb = _vdjdb()
+    mask = pd.Series(True, index=vdjdb.index)
+    for k, v in search.items():
+        mask &= vdjdb[k].str.contains(str(v), regex=False)
+
+    expected = vdjdb[mask]
+    if sort:
+        expected = expected.sort_values(["complex.id", "gene"], kind="stable")
+
+    return expected
+
+
+SEARCHES = [
+    {"gene": "TRB"},
+    {"v.segm": "TCRBV12"},
+    {"gene": "TR", "j.segm": "J02-07"},
+    {"complex.id": "10", "gene": "TRB"},
+    {"cdr3": "CASS", "vdjdb.score": 3},
+    {"cdr3": "NOMATCH"},
+]
+
+
+@pytest.mark.parametrize("prepared", [True, False])
+@pytest.mark.parametrize("search", SEARCHES)
+def test_find_matches_plain_mask(search, prepared):
+    result = _tcrdb(prepared).find(search, construct_only=False)
+
+    # same rows, order and index labels, with text compared regardless of dtype
+    pd.testing.assert_frame_equal(result.astype(str), _expected(search).astype(str))
+
+
+@pytest.mark.parametrize("search", SEARCHES)
+def test_find_unsorted(search):
+    result = _tcrdb(prepared=False).find(search, construct_only=False, sort=False)
+
+    pd.testing.assert_frame_equal(result, _expected(search, sort=False))
+
+
+def test_find_substring_on_categorical():
+    tcrdb = _tcrdb()
+    assert isinstance(tcrdb.vdjdb["v.segm"].dtype, pd.CategoricalDtype)
+
+    result = tcrdb.find({"v.segm": "TCRBV12"})
+
+    assert sorted(result["v.segm"]) == ["TCRBV12*01", "TCRBV12-01*01", "TCRBV12-03*01"]
+
+
+def test_find_construct_only():
+    result = _tcrdb().find({"gene": "TRA"})
+
+    assert list(result.columns) == ["gene", "cdr3", "v.segm", "j.segm", "complex.id"]
+
+
+@pytest.mark.parametrize("cache", [False, True])
+def test_find_numeric_values_match_as_text(cache, tmp_path):
+    tcrdb = _tcrdb()
+    if cache:  # categories come back from parquet with another dtype
+        tcrdb.vdjdb.to_parquet(tmp_path / "vdjdb.parquet")
+        tcrdb.vdjdb = pd.read_parquet(tmp_path / "vdjdb.parquet")
+
+    as_text = tcrdb.find({"complex.id": "10", "vdjdb.score": "2"}, construct_only=False)
+
+    pd.testing.assert_frame_equal(
+        tcrdb.find({"complex.id": 10, "vdjdb.score": 2}, construct_only=False), as_text
+    )
+    assert len(as_text) == 2
+    assert tcrdb.find({"gene": 1}).empty
+
+
+def test_find_with_shared_matches():
+    searches = [
+        {"gene": "TRB", "cdr3": "CASS"},
+        {"gene": "TRB", "complex.id": 10},
+        {"gene": "TRA"},
+    ]
+
+    tcrdb = _tcrdb()
+    tcrdb._share_matches(searches)
+
+    assert set(tcrdb._shared_matches) == {("gene", "TRB")}
+    for search in searches:
+        pd.testing.assert_frame_equal(
+            tcrdb.find(search, construct_only=False).astype(str),
+            _expected(search).astype(str),
+        )
+
+
+def test_reassigning_vdjdb_resets_row_state():
+    tcrdb = _tcrdb()
+    tcrdb._share_matches([{"gene": "TRB"}, {"gene": "TRB"}])
+    assert tcrdb._presorted and tcrdb._shared_matches
+
+    tcrdb.vdjdb = _vdjdb()
+
+    assert not tcrdb._presorted
+    assert not tcrdb._shared_matches
+    pd.testing.assert_frame_equal(
+        tcrdb.find({"gene": "TRB"}, construct_only=False), _expected({"gene": "TRB"})
+    )